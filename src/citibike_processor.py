@@ -1,48 +1,117 @@
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
 import networkx as nx
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import glob
 
+# Explicit schema for the Citibike trip CSVs. Timestamps are parsed by Arrow's
+# C reader and repeated strings are dictionary encoded (categoricals in pandas).
+CATEGORY_TYPE = pa.dictionary(pa.int32(), pa.string())
+CONVERT_OPTIONS = pv.ConvertOptions(
+    column_types={
+        'rideable_type': CATEGORY_TYPE,
+        'started_at': pa.timestamp('us'),
+        'ended_at': pa.timestamp('us'),
+        'start_station_name': CATEGORY_TYPE,
+        'end_station_name': CATEGORY_TYPE,
+        'start_lat': pa.float32(),
+        'start_lng': pa.float32(),
+        'end_lat': pa.float32(),
+        'end_lng': pa.float32(),
+        'member_casual': CATEGORY_TYPE,
+    },
+    include_columns=[
+        'rideable_type', 'started_at', 'ended_at',
+        'start_station_name', 'end_station_name',
+        'start_lat', 'start_lng', 'end_lat', 'end_lng', 'member_casual',
+    ],
+    # Blank station names are missing values (as with pd.read_csv), so the
+    # groupbys drop those trips instead of creating a '' station
+    strings_can_be_null=True,
+)
+
+def _load_one(file):
+    """
+    Read a single trip CSV and apply the member, location and duration filters.
+    """
+    table = pv.read_csv(file, convert_options=CONVERT_OPTIONS)
+    
+    # Apply the row filters on the Arrow table, so only the surviving rows are
+    # converted to pandas datetimes and categoricals
+    lat_bounds = (40.4774, 40.9176)  # NYC latitude bounds
+    lon_bounds = (-74.2590, -73.7004)  # NYC longitude bounds
+    
+    # Filter for member rides only
+    mask = pc.fill_null(pc.equal(table['member_casual'], 'member'), False).to_numpy()
+    
+    # Filter latitude and longitude outliers (NYC approximate bounds).
+    # All comparisons write into one scratch buffer and are folded into the
+    # mask in place, so no per-comparison temporaries are allocated
+    scratch = np.empty_like(mask)
+    for col, (low, high) in [('start_lat', lat_bounds), ('start_lng', lon_bounds),
+                             ('end_lat', lat_bounds), ('end_lng', lon_bounds)]:
+        values = table[col].to_numpy()
+        mask &= np.greater_equal(values, low, out=scratch)
+        mask &= np.less_equal(values, high, out=scratch)
+    
+    table = table.filter(pa.array(mask))
+    df = table.to_pandas()
+    
+    # Filter trip duration outliers
+    # Calculate trip duration in minutes (started_at/ended_at are already
+    # datetime64[us], per CONVERT_OPTIONS). Subtract views of the raw int64
+    # microsecond values and scale once, instead of going through intermediate
+    # timedelta and float-seconds arrays
+    start_us = df['started_at'].to_numpy().view('i8')
+    end_us = df['ended_at'].to_numpy().view('i8')
+    duration = (end_us - start_us).astype(np.float64, copy=False)
+    duration *= 1.0 / 60_000_000.0
+    df['duration_minutes'] = duration
+    
+    # Filter out unreasonable durations (less than 1 minute or more than 12 hours)
+    df = df[(df['duration_minutes'] >= 1) & (df['duration_minutes'] <= 720)]
+    
+    # Add day type (weekend/weekday) from whole days since the epoch.
+    # 1970-01-01 was a Thursday, so +3 maps Monday to 0 like dt.dayofweek
+    days = df['started_at'].to_numpy().view('i8') // 86_400_000_000
+    df['is_weekend'] = ((days + 3) % 7) >= 5
+    
+    return df
+
+def _unify_categories(dfs, column_groups):
+    """
+    Give every categorical column in a group the same categories across all
+    DataFrames, so pd.concat keeps them categorical and columns in the same
+    group (start/end station) can be compared against each other.
+    """
+    for columns in column_groups:
+        categories = pd.Index(np.concatenate(
+            [df[col].cat.categories for df in dfs for col in columns]
+        )).unique()
+        for df in dfs:
+            for col in columns:
+                df[col] = df[col].cat.set_categories(categories)
+
 def load_and_filter_data(csv_files):
     """
     Load and filter Citibike trip data from multiple CSV files.
     Only includes member rides and filters outliers.
     """
-    dfs = []
+    # Files are independent and the Arrow/pandas internals release the GIL,
+    # so read and filter them on a thread pool
+    with ThreadPoolExecutor(max_workers=min(8, len(csv_files))) as ex:
+        dfs = list(ex.map(_load_one, csv_files))
     
-    for file in csv_files:
-        df = pd.read_csv(file)
-        # Filter for member rides only
-        df = df[df['member_casual'] == 'member']
-        
-        # Filter latitude and longitude outliers (NYC approximate bounds)
-        lat_bounds = (40.4774, 40.9176)  # NYC latitude bounds
-        lon_bounds = (-74.2590, -73.7004)  # NYC longitude bounds
-        
-        df = df[
-            (df['start_lat'].between(*lat_bounds)) &
-            (df['start_lng'].between(*lon_bounds)) &
-            (df['end_lat'].between(*lat_bounds)) &
-            (df['end_lng'].between(*lon_bounds))
-        ]
-        
-        # Filter trip duration outliers
-        # Convert ended_at and started_at to datetime if they aren't already
-        df['ended_at'] = pd.to_datetime(df['ended_at'])
-        df['started_at'] = pd.to_datetime(df['started_at'])
-        
-        # Calculate trip duration in minutes
-        df['duration_minutes'] = (df['ended_at'] - df['started_at']).dt.total_seconds() / 60
-        
-        # Filter out unreasonable durations (less than 1 minute or more than 12 hours)
-        df = df[(df['duration_minutes'] >= 1) & (df['duration_minutes'] <= 720)]
-        
-        # Add day type (weekend/weekday)
-        df['is_weekend'] = df['started_at'].dt.dayofweek.isin([5, 6])
-        
-        dfs.append(df)
-    
-    return pd.concat(dfs, ignore_index=True)
+    _unify_categories(dfs, [
+        ['start_station_name', 'end_station_name'],
+        ['rideable_type'],
+        ['member_casual'],
+    ])
+    return pd.concat(dfs, ignore_index=True, copy=False)
 
 def create_network_graphs(df):
     """
@@ -50,75 +119,134 @@ def create_network_graphs(df):
     Edges contain trip count and separate average durations for electric and classic bikes.
     Excludes self-edges (trips that start and end at the same station).
     """
-    # Create separate dataframes for weekday and weekend
-    weekday_df = df[~df['is_weekend']]
-    weekend_df = df[df['is_weekend']]
+    # Station coordinates, one row per station. The station name determines
+    # its location, so coordinates don't need to be part of any groupby key
+    coords = pd.concat([
+        df[['start_station_name', 'start_lat', 'start_lng']].set_axis(['station_name', 'latitude', 'longitude'], axis=1),
+        df[['end_station_name', 'end_lat', 'end_lng']].set_axis(['station_name', 'latitude', 'longitude'], axis=1)
+    ], ignore_index=True).drop_duplicates('station_name').set_index('station_name')
+    
+    # Split into weekday and weekend rows from a single mask, dropping
+    # self-edges (trips that start and end at the same station) at the same time
+    is_weekend = df['is_weekend'].to_numpy()
+    is_trip = (df['start_station_name'] != df['end_station_name']).to_numpy()
+    weekday_idx = np.flatnonzero(~is_weekend & is_trip)
+    weekend_idx = np.flatnonzero(is_weekend & is_trip)
     
     graphs = {}
-    for day_type, data in [('weekday', weekday_df), ('weekend', weekend_df)]:
-        # Remove self-edges (where start and end stations are the same)
-        data = data[data['start_station_name'] != data['end_station_name']]
-        
-        # Separate calculations for electric and classic bikes
-        grouped = data.groupby(
-            ['start_station_name', 'start_lat', 'start_lng',
-            'end_station_name', 'end_lat', 'end_lng', 'rideable_type']
-        ).agg({
-            'duration_minutes': 'mean',
-            'ride_id': 'count'
-        }).reset_index()
+    for day_type, idx in [('weekday', weekday_idx), ('weekend', weekend_idx)]:
+        data = df.take(idx)
         
-        # Pivot the data to get separate columns for each bike type
-        pivoted = grouped.pivot_table(
-            index=['start_station_name', 'start_lat', 'start_lng',
-                    'end_station_name', 'end_lat', 'end_lng'],
-            columns='rideable_type',
-            values=['duration_minutes', 'ride_id'],
-            fill_value=0
-        ).reset_index()
-        
-        # Flatten column names
-        pivoted.columns = [f"{'' if col[0] == '' else col[0]}_{col[1]}" if col[1] != '' 
-                            else col[0] for col in pivoted.columns]
+        # Separate calculations for electric and classic bikes: a total trip
+        # count per station pair plus one mean-duration pass per bike type,
+        # aligned on the (start, end) index
+        keys = ['start_station_name', 'end_station_name']
+        trip_count = data.groupby(keys, observed=True, sort=False).size()
+        mean_durations = [
+            data[data['rideable_type'] == bike_type]
+                .groupby(keys, observed=True, sort=False)['duration_minutes'].mean()
+                .rename(f'{bike_type}_duration')
+            for bike_type in ('electric_bike', 'classic_bike')
+        ]
+        edges = pd.concat([trip_count.rename('trip_count'), *mean_durations], axis=1).fillna(0)
         
         # Create directed graph
         G = nx.DiGraph()
         
         # Add nodes with positions
-        start_stations = pivoted[['start_station_name', 'start_lat', 'start_lng']].drop_duplicates()
-        end_stations = pivoted[['end_station_name', 'end_lat', 'end_lng']].drop_duplicates()
-        
-        for _, row in start_stations.iterrows():
-            G.add_node(row['start_station_name'],
-                      latitude=row['start_lat'],
-                      longitude=row['start_lng'])
-            
-        for _, row in end_stations.iterrows():
-            G.add_node(row['end_station_name'],
-                      latitude=row['end_lat'],
-                      longitude=row['end_lng'])
+        stations = pd.unique(np.concatenate([
+            edges.index.get_level_values('start_station_name').to_numpy(),
+            edges.index.get_level_values('end_station_name').to_numpy()
+        ]))
+        station_coords = coords.loc[stations]
+        G.add_nodes_from(
+            (name, {'latitude': float(lat), 'longitude': float(lng)})
+            for name, lat, lng in zip(
+                stations,
+                station_coords['latitude'].to_numpy(),
+                station_coords['longitude'].to_numpy()
+            )
+        )
         
         # Add edges with properties
-        for _, row in pivoted.iterrows():
-            # Sum up all bike type trips for total count
-            total_trips = sum(row[col] for col in pivoted.columns if col.startswith('ride_id_'))
-            
-            edge_properties = {
-                'trip_count': int(total_trips),
-                'electric_bike_duration': float(row.get('duration_minutes_electric_bike', 0)),
-                'classic_bike_duration': float(row.get('duration_minutes_classic_bike', 0))
-            }
-            
-            G.add_edge(
-                row['start_station_name'],
-                row['end_station_name'],
-                **edge_properties
-            )
+        G.add_edges_from(
+            (u, v, {
+                'trip_count': int(count),
+                'electric_bike_duration': float(electric),
+                'classic_bike_duration': float(classic)
+            })
+            for (u, v), count, electric, classic in edges.itertuples(index=True, name=None)
+        )
         
         graphs[day_type] = G
     
     return graphs
 
+def save_graph(G, path_prefix):
+    """
+    Save a station graph as two Parquet tables: {path_prefix}_nodes.parquet
+    (station plus node attributes) and {path_prefix}_edges.parquet
+    (source, target plus edge attributes).
+    """
+    # Fixed columns, so an empty graph still writes the full schema
+    nodes = pd.DataFrame(
+        [(n, d['latitude'], d['longitude']) for n, d in G.nodes(data=True)],
+        columns=['station', 'latitude', 'longitude']
+    )
+    edges = pd.DataFrame(
+        [(u, v, d['trip_count'], d['electric_bike_duration'], d['classic_bike_duration'])
+         for u, v, d in G.edges(data=True)],
+        columns=['source', 'target', 'trip_count',
+                 'electric_bike_duration', 'classic_bike_duration']
+    )
+    # Coordinates were read as float32 and only carry ~5 decimals, so keep
+    # them float32 on disk as well
+    nodes = nodes.astype({'latitude': np.float32, 'longitude': np.float32})
+    nodes.to_parquet(f'{path_prefix}_nodes.parquet', index=False)
+    edges.to_parquet(f'{path_prefix}_edges.parquet', index=False)
+
+def load_graph(path_prefix):
+    """
+    Rebuild a directed station graph from the Parquet tables written by save_graph.
+    """
+    nodes = pd.read_parquet(f'{path_prefix}_nodes.parquet')
+    edges = pd.read_parquet(f'{path_prefix}_edges.parquet')
+    
+    G = nx.DiGraph()
+    G.add_nodes_from(zip(
+        nodes['station'],
+        nodes.drop(columns='station').to_dict('records')
+    ))
+    G.add_edges_from(zip(
+        edges['source'],
+        edges['target'],
+        edges.drop(columns=['source', 'target']).to_dict('records')
+    ))
+    return G
+
+def _network_prefix(path):
+    """Strip a legacy .gml suffix so a graph path can name either storage format."""
+    path = str(path)
+    return path[:-len('.gml')] if path.endswith('.gml') else path
+
+def network_exists(path):
+    """
+    True if a graph saved by save_graph, or a legacy .gml file, exists at path.
+    """
+    prefix = _network_prefix(path)
+    return Path(f'{prefix}_edges.parquet').exists() or Path(f'{prefix}.gml').exists()
+
+def read_network(path):
+    """
+    Load a station graph from a path prefix or a .gml path. Prefers the
+    Parquet node/edge tables written by save_graph and falls back to
+    {prefix}.gml when those haven't been generated.
+    """
+    prefix = _network_prefix(path)
+    if Path(f'{prefix}_edges.parquet').exists():
+        return load_graph(prefix)
+    return nx.read_gml(f'{prefix}.gml')
+
 def main():
     # Get all CSV files in the data directory
     data_dir = Path('202408-citibike-tripdata')
@@ -137,9 +265,9 @@ def main():
     
     # Save graphs
     for day_type, G in graphs.items():
-        output_path = f'citibike_{day_type}_network.gml'
-        nx.write_gml(G, output_path)
-        print(f"Saved {day_type} graph to {output_path}")
+        output_prefix = f'citibike_{day_type}_network'
+        save_graph(G, output_prefix)
+        print(f"Saved {day_type} graph to {output_prefix}_nodes.parquet / {output_prefix}_edges.parquet")
         print(f"Graph has {G.number_of_nodes()} nodes and {G.number_of_edges()} edges")
 
 if __name__ == "__main__":
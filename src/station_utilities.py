@@ -1,11 +1,41 @@
 import pandas as pd
 import networkx as nx
 import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pv
+from functools import lru_cache
 from pathlib import Path
-from haversine import haversine, Unit
+from scipy.spatial import cKDTree
+from citibike_processor import network_exists, read_network
 from typing import Tuple, List, Dict, Optional
 import warnings
 
+# Mean Earth radius used by haversine's Unit.KILOMETERS
+EARTH_RADIUS_KM = 6371.0088
+
+
+def _to_xyz(latitude, longitude) -> np.ndarray:
+    """
+    Convert lat/lng in degrees to 3D points on a sphere of radius EARTH_RADIUS_KM.
+    Euclidean nearest neighbours in this space are great-circle nearest neighbours.
+    """
+    lat = np.radians(np.asarray(latitude, dtype=np.float64))
+    lng = np.radians(np.asarray(longitude, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return EARTH_RADIUS_KM * np.column_stack([cos_lat * np.cos(lng),
+                                              cos_lat * np.sin(lng),
+                                              np.sin(lat)])
+
+
+def _chord_to_arc_km(chord_km):
+    """
+    Convert straight-line distances between _to_xyz points into great-circle km.
+    Equivalent to haversine on the original lat/lng pairs.
+    """
+    ratio = np.clip(np.asarray(chord_km, dtype=np.float64) / (2 * EARTH_RADIUS_KM), 0.0, 1.0)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(ratio)
+
 
 class StationFinder:
     """
@@ -24,7 +54,8 @@ class StationFinder:
         Parameters:
         -----------
         citibike_graph_path : str
-            Path to the Citibike network GML file
+            Path to the Citibike network: the prefix written by citibike_processor
+            (Parquet node/edge tables) or a GML file
         subway_graph_path : str
             Path to the subway network GML file
         subway_coords_path : str, optional
@@ -43,9 +74,22 @@ class StationFinder:
         self.citibike_stations = self._extract_citibike_coords()
         self.subway_stations = self._extract_subway_coords()
         
+        # Plain ndarray copies of the station tables for lookups in hot loops
+        self._citibike_coords = self.citibike_stations[['latitude', 'longitude']].to_numpy(dtype=np.float64)
+        self._citibike_names = self.citibike_stations['station_name'].to_numpy()
+        self._subway_coords = self.subway_stations[['latitude', 'longitude']].to_numpy(dtype=np.float64)
+        self._subway_names = self.subway_stations['station_name'].to_numpy()
+        
+        # Spatial indexes over the stations, built once
+        self.citibike_tree = cKDTree(_to_xyz(self._citibike_coords[:, 0], self._citibike_coords[:, 1]))
+        self.subway_tree = cKDTree(_to_xyz(self._subway_coords[:, 0], self._subway_coords[:, 1]))
+        
+        # Per-instance cache of radius queries, keyed on the exact query arguments
+        self._radius_query = lru_cache(maxsize=8192)(self._stations_within_radius)
+        
     def _load_citibike_graph(self) -> nx.DiGraph:
-        """Load the Citibike graph from GML file."""
-        return nx.read_gml(self.citibike_graph_path)
+        """Load the Citibike graph from its Parquet tables, or a GML file."""
+        return read_network(self.citibike_graph_path)
     
     def _load_subway_graph(self) -> nx.Graph:
         """Load the subway graph from GML file."""
@@ -56,18 +100,28 @@ class StationFinder:
         Extract Citibike station coordinates from the graph.
         Returns DataFrame with columns: station_name, latitude, longitude
         """
-        stations = []
-        for node, data in self.citibike_graph.nodes(data=True):
-            stations.append({
-                'station_name': node,
-                'latitude': data.get('latitude'),
-                'longitude': data.get('longitude')
-            })
+        n = self.citibike_graph.number_of_nodes()
+        names = np.empty(n, dtype=object)
+        lat = np.full(n, np.nan)
+        lon = np.full(n, np.nan)
+        
+        # Fill the columns in one pass over the nodes
+        for i, (node, data) in enumerate(self.citibike_graph.nodes(data=True)):
+            names[i] = node
+            node_lat = data.get('latitude')
+            node_lon = data.get('longitude')
+            if node_lat is not None:
+                lat[i] = node_lat
+            if node_lon is not None:
+                lon[i] = node_lon
         
-        df = pd.DataFrame(stations)
         # Remove any stations with missing coordinates
-        df = df.dropna(subset=['latitude', 'longitude'])
-        return df
+        keep = ~(np.isnan(lat) | np.isnan(lon))
+        return pd.DataFrame({
+            'station_name': names[keep],
+            'latitude': lat[keep],
+            'longitude': lon[keep]
+        })
     
     def _extract_subway_coords(self) -> pd.DataFrame:
         """
@@ -112,15 +166,23 @@ class StationFinder:
             response = urllib.request.urlopen(url, timeout=30)
             zip_data = io.BytesIO(response.read())
             
+            # Only read the four columns we use
+            convert_options = pv.ConvertOptions(
+                include_columns=['stop_id', 'stop_name', 'stop_lat', 'stop_lon'],
+                column_types={'stop_id': pa.string(), 'stop_name': pa.string(),
+                              'stop_lat': pa.float64(), 'stop_lon': pa.float64()}
+            )
             with zipfile.ZipFile(zip_data) as z:
                 with z.open('stops.txt') as f:
-                    stops_df = pd.read_csv(f)
+                    stops = pv.read_csv(f, convert_options=convert_options)
             
             # Filter for stations only (not individual platforms)
             # Station IDs without directional suffix (N/S)
-            stops_df = stops_df[~stops_df['stop_id'].str.endswith(('N', 'S'))]
+            is_platform = pc.or_(pc.ends_with(stops['stop_id'], 'N'),
+                                 pc.ends_with(stops['stop_id'], 'S'))
+            stops = stops.filter(pc.invert(pc.fill_null(is_platform, False)))
             
-            df = stops_df[['stop_name', 'stop_lat', 'stop_lon']].copy()
+            df = stops.select(['stop_name', 'stop_lat', 'stop_lon']).to_pandas()
             df.columns = ['station_name', 'latitude', 'longitude']
             df = df.drop_duplicates(subset=['station_name'])
             
@@ -135,6 +197,40 @@ class StationFinder:
                 "columns: station_name, latitude, longitude via subway_coords_path parameter."
             )
     
+    def _station_arrays(self, kind: str) -> Tuple[np.ndarray, np.ndarray, cKDTree]:
+        """Return (coords, names, tree) for 'citibike' or 'subway' stations."""
+        if kind == 'citibike':
+            return self._citibike_coords, self._citibike_names, self.citibike_tree
+        if kind == 'subway':
+            return self._subway_coords, self._subway_names, self.subway_tree
+        raise ValueError(f"kind must be 'citibike' or 'subway', got {kind!r}")
+    
+    def nearest_station_indices(self, latitudes, longitudes,
+                                kind: str = 'citibike') -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Find the nearest station of the given kind for a batch of points.
+        
+        Parameters:
+        -----------
+        latitudes : array-like
+            Latitudes of the query points
+        longitudes : array-like
+            Longitudes of the query points
+        kind : str
+            'citibike' or 'subway' (default: 'citibike')
+            
+        Returns:
+        --------
+        tuple
+            (indices, distances_km) - positional indices into the station
+            arrays/DataFrame and the haversine distance to each nearest station
+        """
+        _, _, tree = self._station_arrays(kind)
+        chord_km, indices = tree.query(_to_xyz(latitudes, longitudes), k=1, workers=-1)
+        
+        # The tree already measured the chord, so no second haversine pass
+        return indices, _chord_to_arc_km(chord_km)
+    
     def create_citibike_to_subway_mapping(self, output_path: str = 'src/outputs/citibike_to_subway_mapping.csv') -> pd.DataFrame:
         """
         Create a lookup table mapping each Citibike station to its closest subway station.
@@ -150,36 +246,20 @@ class StationFinder:
             DataFrame with columns: citibike_station, citibike_lat, citibike_lng,
                                    closest_subway_station, subway_lat, subway_lng, distance_km
         """
-        mappings = []
-        
-        for _, citibike_row in self.citibike_stations.iterrows():
-            cb_point = (citibike_row['latitude'], citibike_row['longitude'])
-            
-            # Calculate distance to all subway stations
-            min_distance = float('inf')
-            closest_subway = None
-            closest_coords = None
-            
-            for _, subway_row in self.subway_stations.iterrows():
-                subway_point = (subway_row['latitude'], subway_row['longitude'])
-                distance = haversine(cb_point, subway_point, unit=Unit.KILOMETERS)
-                
-                if distance < min_distance:
-                    min_distance = distance
-                    closest_subway = subway_row['station_name']
-                    closest_coords = subway_point
-            
-            mappings.append({
-                'citibike_station': citibike_row['station_name'],
-                'citibike_lat': citibike_row['latitude'],
-                'citibike_lng': citibike_row['longitude'],
-                'closest_subway_station': closest_subway,
-                'subway_lat': closest_coords[0] if closest_coords else None,
-                'subway_lng': closest_coords[1] if closest_coords else None,
-                'distance_km': min_distance
-            })
+        # One batched nearest-neighbour query for all Citibike stations
+        idx, distances = self.nearest_station_indices(
+            self._citibike_coords[:, 0], self._citibike_coords[:, 1], kind='subway'
+        )
         
-        mapping_df = pd.DataFrame(mappings)
+        mapping_df = pd.DataFrame({
+            'citibike_station': self._citibike_names,
+            'citibike_lat': self._citibike_coords[:, 0],
+            'citibike_lng': self._citibike_coords[:, 1],
+            'closest_subway_station': self._subway_names[idx],
+            'subway_lat': self._subway_coords[idx, 0],
+            'subway_lng': self._subway_coords[idx, 1],
+            'distance_km': distances
+        })
         
         # Save to CSV
         mapping_df.to_csv(output_path, index=False)
@@ -210,47 +290,52 @@ class StationFinder:
             Dictionary with keys 'citibike' and 'subway', each containing a DataFrame
             with columns: station_name, latitude, longitude, distance_km
         """
-        center_point = (latitude, longitude)
-        
-        # Find Citibike stations within radius
-        citibike_within = []
-        for _, row in self.citibike_stations.iterrows():
-            station_point = (row['latitude'], row['longitude'])
-            distance = haversine(center_point, station_point, unit=Unit.KILOMETERS)
-            
-            if distance <= radius_km:
-                citibike_within.append({
-                    'station_name': row['station_name'],
-                    'latitude': row['latitude'],
-                    'longitude': row['longitude'],
-                    'distance_km': distance
+        result = {}
+        for kind in ['citibike', 'subway']:
+            coords, names, _ = self._station_arrays(kind)
+            positions, distances = self._radius_query(kind, latitude, longitude, radius_km)
+            if len(positions):
+                df = pd.DataFrame({
+                    'station_name': names[positions],
+                    'latitude': coords[positions, 0],
+                    'longitude': coords[positions, 1],
+                    'distance_km': distances.copy()
                 })
+            else:
+                df = pd.DataFrame()
+            result[kind] = df
         
-        # Find subway stations within radius
-        subway_within = []
-        for _, row in self.subway_stations.iterrows():
-            station_point = (row['latitude'], row['longitude'])
-            distance = haversine(center_point, station_point, unit=Unit.KILOMETERS)
-            
-            if distance <= radius_km:
-                subway_within.append({
-                    'station_name': row['station_name'],
-                    'latitude': row['latitude'],
-                    'longitude': row['longitude'],
-                    'distance_km': distance
-                })
+        return result
+    
+    def _stations_within_radius(self, kind: str, latitude: float, longitude: float,
+                                radius_km: float) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Positional indices and distances of stations within radius_km, sorted by distance.
+        Called through self._radius_query, which caches the results.
+        """
+        _, _, tree = self._station_arrays(kind)
+        center = _to_xyz(latitude, longitude)[0]
         
-        citibike_df = pd.DataFrame(citibike_within).sort_values('distance_km') if citibike_within else pd.DataFrame()
-        subway_df = pd.DataFrame(subway_within).sort_values('distance_km') if subway_within else pd.DataFrame()
+        # Great-circle radius -> straight-line radius in xyz space. Chord length
+        # grows monotonically with arc length, so the tree rejects far stations
+        # and we sort on the chord; arcsin is only taken for the stations kept
+        chord_radius = 2 * EARTH_RADIUS_KM * np.sin(min(radius_km / (2 * EARTH_RADIUS_KM), np.pi / 2))
+        positions = np.asarray(tree.query_ball_point(center, chord_radius), dtype=np.intp)
         
-        return {
-            'citibike': citibike_df,
-            'subway': subway_df
-        }
+        chords = np.linalg.norm(tree.data[positions] - center, axis=1)
+        order = np.argsort(chords, kind='stable')
+        positions = positions[order]
+        distances = _chord_to_arc_km(chords[order])
+        
+        # Cached results are shared between callers, so keep them read-only
+        positions.setflags(write=False)
+        distances.setflags(write=False)
+        return positions, distances
     
     def generate_random_points_in_circle(self, latitude: float, longitude: float, 
                                          radius_km: float = 1.0, 
-                                         num_points: int = 10) -> pd.DataFrame:
+                                         num_points: int = 10,
+                                         seed: Optional[int] = None) -> pd.DataFrame:
         """
         Generate random points uniformly distributed within a circle.
         
@@ -264,6 +349,9 @@ class StationFinder:
             Radius in kilometers (default: 1.0 km)
         num_points : int
             Number of random points to generate (default: 10)
+        seed : int, optional
+            Seed for a dedicated generator. If None, points are drawn from NumPy's
+            global random state, so np.random.seed still makes them reproducible
             
         Returns:
         --------
@@ -276,32 +364,30 @@ class StationFinder:
         # Convert radius to degrees (approximate)
         radius_deg = (radius_km / earth_radius_km) * (180 / np.pi)
         
-        points = []
-        for i in range(num_points):
-            # Generate random radius and angle
-            # Use sqrt for uniform distribution in circle
-            r = radius_deg * np.sqrt(np.random.random())
-            theta = 2 * np.pi * np.random.random()
-            
-            # Convert polar to Cartesian, accounting for latitude compression
-            # At higher latitudes, longitude degrees are shorter
-            lat_offset = r * np.cos(theta)
-            lng_offset = r * np.sin(theta) / np.cos(np.radians(latitude))
-            
-            point_lat = latitude + lat_offset
-            point_lng = longitude + lng_offset
-            
-            # Calculate actual distance
-            distance = haversine((latitude, longitude), (point_lat, point_lng), unit=Unit.KILOMETERS)
-            
-            points.append({
-                'point_id': i + 1,
-                'latitude': point_lat,
-                'longitude': point_lng,
-                'distance_from_center_km': distance
-            })
+        # Draw all radii and angles at once
+        # Use sqrt for uniform distribution in circle
+        rng = np.random.default_rng(seed) if seed is not None else np.random
+        r = radius_deg * np.sqrt(rng.random(num_points))
+        theta = 2 * np.pi * rng.random(num_points)
+        
+        # Convert polar to Cartesian, accounting for latitude compression
+        # At higher latitudes, longitude degrees are shorter
+        lat_offset = r * np.cos(theta)
+        lng_offset = r * np.sin(theta) / np.cos(np.radians(latitude))
+        
+        point_lat = latitude + lat_offset
+        point_lng = longitude + lng_offset
+        
+        # Calculate actual great-circle distance for all points at once
+        chords = np.linalg.norm(_to_xyz(point_lat, point_lng) - _to_xyz(latitude, longitude), axis=1)
+        distances = _chord_to_arc_km(chords)
         
-        return pd.DataFrame(points)
+        return pd.DataFrame({
+            'point_id': np.arange(1, num_points + 1),
+            'latitude': point_lat,
+            'longitude': point_lng,
+            'distance_from_center_km': distances
+        })
 
 
 def main():
@@ -311,14 +397,14 @@ def main():
     import sys
     
     # Paths to graph files
-    citibike_weekday = 'citibike_weekday_network.gml'
-    citibike_weekend = 'citibike_weekend_network.gml'
+    citibike_weekday = 'citibike_weekday_network'
+    citibike_weekend = 'citibike_weekend_network'
     subway_graph = 'subway_graph_weekday_weekend.gml'
     
     # Check which Citibike graph to use
-    citibike_path = citibike_weekday if Path(citibike_weekday).exists() else citibike_weekend
+    citibike_path = citibike_weekday if network_exists(citibike_weekday) else citibike_weekend
     
-    if not Path(citibike_path).exists():
+    if not network_exists(citibike_path):
         print("Error: Citibike graph not found. Please run citibike_processor.py first.")
         sys.exit(1)
     
@@ -4,19 +4,20 @@ Visualize Citibike NetworkX graph overlaid on NYC map
 Supports multiple visualization methods: static (geopandas), interactive (folium), 3D (pydeck)
 """
 
-import networkx as nx
+import numpy as np
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import Point, LineString
+import shapely
 import matplotlib.pyplot as plt
 import contextily as ctx
 from pathlib import Path
+from citibike_processor import network_exists, read_network
 
 
 def load_graph(graph_path):
-    """Load a NetworkX graph from GML file."""
+    """Load a NetworkX graph from its Parquet node/edge tables or a GML file."""
     print(f"Loading graph from {graph_path}...")
-    G = nx.read_gml(graph_path)
+    G = read_network(graph_path)
     print(f"  Loaded {G.number_of_nodes()} nodes and {G.number_of_edges()} edges")
     return G
 
@@ -35,8 +36,8 @@ def prepare_geodataframes(G, top_n_edges=None):
     """
     print("Creating GeoDataFrames from graph...")
     
-    # Create nodes GeoDataFrame
-    node_data = []
+    # Resolve each node's coordinates once
+    node_ids, names, lats, lons = [], [], [], []
     for node_id, attrs in G.nodes(data=True):
         # Handle different attribute names (latitude/lat, longitude/lon/lng)
         lat = attrs.get('latitude') or attrs.get('lat')
@@ -45,51 +46,77 @@ def prepare_geodataframes(G, top_n_edges=None):
         if lat is None or lon is None:
             print(f"Warning: Node {node_id} missing coordinates, skipping")
             continue
-            
-        node_data.append({
-            'node_id': node_id,
-            'name': attrs.get('name', str(node_id)),
-            'geometry': Point(lon, lat),
-            'degree': G.degree(node_id),
-            'in_degree': G.in_degree(node_id) if G.is_directed() else G.degree(node_id),
-            'out_degree': G.out_degree(node_id) if G.is_directed() else G.degree(node_id),
-        })
-    
-    nodes_gdf = gpd.GeoDataFrame(node_data, crs='EPSG:4326')
+        
+        node_ids.append(node_id)
+        names.append(attrs.get('name', str(node_id)))
+        lats.append(lat)
+        lons.append(lon)
+    
+    lats = np.asarray(lats, dtype=np.float64)
+    lons = np.asarray(lons, dtype=np.float64)
+    
+    # Degrees in one call each rather than three calls per node
+    degree = dict(G.degree())
+    in_degree = dict(G.in_degree()) if G.is_directed() else degree
+    out_degree = dict(G.out_degree()) if G.is_directed() else degree
+    
+    # Create nodes GeoDataFrame
+    nodes_gdf = gpd.GeoDataFrame({
+        'node_id': node_ids,
+        'name': names,
+        'degree': [degree[n] for n in node_ids],
+        'in_degree': [in_degree[n] for n in node_ids],
+        'out_degree': [out_degree[n] for n in node_ids],
+    }, geometry=gpd.points_from_xy(lons, lats), crs='EPSG:4326')
     print(f"  Created {len(nodes_gdf)} nodes")
     
+    # Map node ids to rows of the coordinate arrays
+    name2idx = {node_id: i for i, node_id in enumerate(node_ids)}
+    
     # Create edges GeoDataFrame
-    edge_data = []
+    sources, targets, src_idx, dst_idx, weights = [], [], [], [], []
     for u, v, attrs in G.edges(data=True):
-        u_data = G.nodes[u]
-        v_data = G.nodes[v]
-        
-        # Get coordinates
-        u_lat = u_data.get('latitude') or u_data.get('lat')
-        u_lon = u_data.get('longitude') or u_data.get('lon') or u_data.get('lng')
-        v_lat = v_data.get('latitude') or v_data.get('lat')
-        v_lon = v_data.get('longitude') or v_data.get('lon') or v_data.get('lng')
-        
-        if None in [u_lat, u_lon, v_lat, v_lon]:
+        ui = name2idx.get(u)
+        vi = name2idx.get(v)
+        if ui is None or vi is None:
             continue
         
         # Get edge weight (try different attribute names)
         weight = attrs.get('trip_count') or attrs.get('weight') or attrs.get('rides') or 1
         
-        edge_data.append({
-            'from': u,
-            'to': v,
-            'weight': float(weight),
-            'geometry': LineString([(u_lon, u_lat), (v_lon, v_lat)])
-        })
-    
-    edges_gdf = gpd.GeoDataFrame(edge_data, crs='EPSG:4326')
+        sources.append(u)
+        targets.append(v)
+        src_idx.append(ui)
+        dst_idx.append(vi)
+        weights.append(float(weight))
+    
+    # Build every edge LineString at once from an (E, 2, 2) coordinate array
+    src_idx = np.asarray(src_idx, dtype=np.intp)
+    dst_idx = np.asarray(dst_idx, dtype=np.intp)
+    edge_coords = np.stack([
+        np.column_stack([lons[src_idx], lats[src_idx]]),
+        np.column_stack([lons[dst_idx], lats[dst_idx]])
+    ], axis=1)
+    
+    edges_gdf = gpd.GeoDataFrame({
+        'from': sources,
+        'to': targets,
+        'weight': np.asarray(weights, dtype=np.float64),
+    }, geometry=shapely.linestrings(edge_coords), crs='EPSG:4326')
     print(f"  Created {len(edges_gdf)} edges")
     
     # Filter to top edges if requested
     if top_n_edges and len(edges_gdf) > top_n_edges:
         print(f"  Filtering to top {top_n_edges} edges by weight...")
-        edges_gdf = edges_gdf.nlargest(top_n_edges, 'weight')
+        # Partial partition finds the cutoff weight in O(E). Edges tied at the
+        # cutoff are taken in original order, like nlargest, and only the
+        # kept k rows get sorted
+        w = edges_gdf['weight'].to_numpy()
+        cutoff = w[np.argpartition(w, -top_n_edges)[-top_n_edges:]].min()
+        above = np.flatnonzero(w > cutoff)
+        tied = np.flatnonzero(w == cutoff)[:top_n_edges - len(above)]
+        top = np.concatenate([above, tied])
+        edges_gdf = edges_gdf.iloc[top].sort_values('weight', ascending=False, kind='stable')
         print(f"  Kept {len(edges_gdf)} edges")
     
     return nodes_gdf, edges_gdf
@@ -245,41 +272,46 @@ def create_interactive_map(nodes_gdf, edges_gdf, output_path, title="Citibike Ne
         tiles='CartoDB positron'
     )
     
-    # Add edges
+    # Add edges as a single GeoJson layer instead of one PolyLine per edge
     print("  Adding edges...")
     max_weight = edges_gdf['weight'].max()
-    for idx, row in edges_gdf.iterrows():
-        # Normalize weight for line thickness
-        weight_normalized = (row['weight'] / max_weight) * 5 + 1
-        
-        coords = [(point[1], point[0]) for point in row.geometry.coords]
-        
-        folium.PolyLine(
-            coords,
-            weight=weight_normalized,
-            color='#ff7f0e',
-            opacity=0.4,
-            popup=f"{row['from']} → {row['to']}<br>Trips: {int(row['weight'])}"
-        ).add_to(m)
+    edge_layer = edges_gdf[['from', 'to', 'geometry']].copy()
+    edge_layer['trips'] = edges_gdf['weight'].astype(int)
+    # Normalize weight for line thickness
+    edge_layer['weight_norm'] = (edges_gdf['weight'] / max_weight) * 5 + 1
+    
+    folium.GeoJson(
+        edge_layer.to_json(),
+        name='Connections',
+        style_function=lambda feature: {
+            'color': '#ff7f0e',
+            'weight': feature['properties']['weight_norm'],
+            'opacity': 0.4
+        },
+        popup=folium.GeoJsonPopup(fields=['from', 'to', 'trips'], aliases=['From', 'To', 'Trips'])
+    ).add_to(m)
     
-    # Add nodes
+    # Add nodes as one clustered array; markers are built in the browser
     print("  Adding nodes...")
-    for idx, row in nodes_gdf.iterrows():
-        # Normalize size
-        size = (row['degree'] / nodes_gdf['degree'].max()) * 10 + 3
-        
-        folium.CircleMarker(
-            location=[row.geometry.y, row.geometry.x],
-            radius=size,
-            popup=f"<b>{row['name']}</b><br>"
-                  f"Total connections: {row['degree']}<br>"
-                  f"Incoming: {row['in_degree']}<br>"
-                  f"Outgoing: {row['out_degree']}",
-            color='white',
-            fillColor='#1f77b4',
-            fillOpacity=0.7,
-            weight=1
-        ).add_to(m)
+    sizes = (nodes_gdf['degree'] / nodes_gdf['degree'].max()) * 10 + 3
+    popups = ("<b>" + nodes_gdf['name'].astype(str) + "</b><br>"
+              "Total connections: " + nodes_gdf['degree'].astype(str) + "<br>"
+              "Incoming: " + nodes_gdf['in_degree'].astype(str) + "<br>"
+              "Outgoing: " + nodes_gdf['out_degree'].astype(str))
+    node_rows = list(zip(nodes_gdf.geometry.y.tolist(), nodes_gdf.geometry.x.tolist(),
+                         sizes.tolist(), popups.tolist()))
+    
+    node_callback = """
+    function (row) {
+        var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {
+            radius: row[2], color: 'white', fillColor: '#1f77b4',
+            fillOpacity: 0.7, weight: 1
+        });
+        marker.bindPopup(row[3]);
+        return marker;
+    }
+    """
+    plugins.FastMarkerCluster(node_rows, callback=node_callback, name='Stations').add_to(m)
     
     # Add title
     title_html = f'''
@@ -318,33 +350,35 @@ def create_pydeck_map(nodes_gdf, edges_gdf, output_path, title="Citibike Network
     print(f"\nCreating PyDeck 3D visualization...")
     
     # Prepare edge data for arc layer
-    edge_data = []
+    # Each edge is a 2-point LineString, so coordinates reshape to (E, 2, 2)
     max_weight = edges_gdf['weight'].max()
-    
-    for idx, row in edges_gdf.iterrows():
-        coords = list(row.geometry.coords)
-        edge_data.append({
-            'from_lon': coords[0][0],
-            'from_lat': coords[0][1],
-            'to_lon': coords[1][0],
-            'to_lat': coords[1][1],
-            'weight': row['weight'],
-            'color': [255, 127, 14, int(100 + (row['weight'] / max_weight) * 155)]
-        })
+    weights = edges_gdf['weight'].to_numpy()
+    edge_coords = shapely.get_coordinates(edges_gdf.geometry.values).reshape(-1, 2, 2)
+    
+    colors = np.empty((len(edges_gdf), 4), dtype=np.uint8)
+    colors[:, :3] = [255, 127, 14]
+    colors[:, 3] = (100 + (weights / max_weight) * 155).astype(np.uint8)
+    
+    edge_data = pd.DataFrame({
+        'from_lon': edge_coords[:, 0, 0],
+        'from_lat': edge_coords[:, 0, 1],
+        'to_lon': edge_coords[:, 1, 0],
+        'to_lat': edge_coords[:, 1, 1],
+        'weight': weights,
+        'color': colors.tolist()
+    })
     
     # Prepare node data
-    node_data = []
     max_degree = nodes_gdf['degree'].max()
     
-    for idx, row in nodes_gdf.iterrows():
-        node_data.append({
-            'lon': row.geometry.x,
-            'lat': row.geometry.y,
-            'name': row['name'],
-            'degree': row['degree'],
-            'elevation': row['degree'] * 5,
-            'radius': (row['degree'] / max_degree) * 100 + 20
-        })
+    node_data = pd.DataFrame({
+        'lon': nodes_gdf.geometry.x.to_numpy(),
+        'lat': nodes_gdf.geometry.y.to_numpy(),
+        'name': nodes_gdf['name'].to_numpy(),
+        'degree': nodes_gdf['degree'].to_numpy(),
+        'elevation': nodes_gdf['degree'].to_numpy() * 5,
+        'radius': (nodes_gdf['degree'].to_numpy() / max_degree) * 100 + 20
+    })
     
     # Create layers
     arc_layer = pdk.Layer(
@@ -407,12 +441,12 @@ def main():
     import sys
     
     # Example: Visualize the weekday network
-    graph_path = 'citibike_weekend_network.gml'
+    graph_path = 'citibike_weekend_network'
     
-    if not Path(graph_path).exists():
+    if not network_exists(graph_path):
         print(f"Graph file not found: {graph_path}")
         print("\nAvailable graph files:")
-        for f in Path('.').rglob('*.gml'):
+        for f in [*Path('.').rglob('*_edges.parquet'), *Path('.').rglob('*.gml')]:
             print(f"  {f}")
         sys.exit(1)
     